@@ -5,54 +5,86 @@
 # Import necessary libraries
 import sqlite3  # For interacting with SQLite database
 from openai import OpenAI  # For using OpenAI's API
+import httpx  # HTTP client used by the OpenAI client
 import os  # For interacting with the operating system
 from dotenv import load_dotenv  # For loading environment variables
+import io
 import json
+import re
+import itertools
+import threading
 import streamlit as st
 import pandas as pd
-import matplotlib.pyplot as plt
+import numpy as np
+from numba import njit, prange
+from matplotlib.figure import Figure
+import sqlglot
+from sqlglot import exp
+import xxhash
+from query_cache import EMBEDDING_MODEL, PERSISTENT_CACHE_DIR, SemanticCache, canonicalize_sql, normalize_question
 
 
 load_dotenv()
 
 api_key = os.getenv("OPENAI_API_KEY")
 db_url = os.getenv("DB_URL")
+openai_model = "gpt-4o-mini"
 
-# Connect to db
-connect = sqlite3.connect(db_url)
-
-def get_table_names():
-    """Get all table names from the database"""
-    table_names = []
-    tables = connect.execute("SELECT name FROM sqlite_master WHERE type='table';")
-    for tables in tables.fetchall():
-        table_names.append(tables[0])
-    return table_names
-
-def get_column_names(table_name):
-    """Get all column names for a specific table"""
-    column_names = []
-    columns = connect.execute(f"PRAGMA table_info('{table_name}');").fetchall()
-    for col in columns:
-        column_names.append(col[1])  
-    return column_names
+# Connect to db once per process. Streamlit reruns this script on every
+# interaction, so the connection is cached as a resource and shared by all
+# sessions; the lock serializes access from Streamlit's worker threads.
+@st.cache_resource
+def get_connection():
+    """Open the persistent database connection"""
+    conn = sqlite3.connect(db_url, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA mmap_size=268435456")
+    conn.execute("PRAGMA cache_size=-65536")
+    return conn
+
+@st.cache_resource
+def get_connection_lock():
+    return threading.Lock()
+
+connect = get_connection()
+connect_lock = get_connection_lock()
 
 def get_database_info():
     """Get information about all tables and their columns in the database"""
-    table_dicts = []
-    for table_name in get_table_names():
-        column_names = get_column_names(table_name)
-        table_dicts.append({"table_name": table_name, "column_names": column_names})
-    return table_dicts
+    # One query over sqlite_master + pragma_table_info instead of a PRAGMA per table
+    rows = connect.execute(
+        "SELECT m.name AS table_name, p.name AS column_name "
+        "FROM sqlite_master m JOIN pragma_table_info(m.name) p "
+        "WHERE m.type='table' ORDER BY m.name, p.cid;"
+    ).fetchall()
+    return [
+        {"table_name": table_name, "column_names": [row[1] for row in table_rows]}
+        for table_name, table_rows in itertools.groupby(rows, key=lambda row: row[0])
+    ]
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def get_schema_string(schema_version):
+    """Convert the database schema to a string format, once per schema version"""
+    databaseSchema = get_database_info()
+    return "\n".join(
+        f"Table: {table['table_name']}\nColumns: {', '.join(table['column_names'])}" for table in databaseSchema
+    )
+
+# Get the database schema information; PRAGMA schema_version changes whenever
+# the schema does, so the cached string is rebuilt only when needed
+with connect_lock:
+    schema_version = connect.execute("PRAGMA schema_version").fetchone()[0]
+    databaseSchema_toString = get_schema_string(schema_version)
 
-# Get the database schema information
-databaseSchema = get_database_info()
 
-# Convert the database schema to a string format
-databaseSchema_toString = "\n".join(
-    f"Table: {table['table_name']}\nColumns: {', '.join(table['column_names'])}" for table in databaseSchema
-)
+# System prompt: stable preamble followed by the schema. Keeping this prefix
+# identical between calls lets OpenAI's automatic prompt caching kick in.
+system_prompt = f"""Answer user questions by generating SQL queries. Write a SQL query to extract the necessary information to answer the user's question. The query should use the database schema below. Ensure that the SQL query is written in plain text and accurately reflects the schema provided.
 
+Database schema:
+{databaseSchema_toString}"""
 
 tools = [
     {
@@ -65,12 +97,7 @@ tools = [
                 "properties": {
                     "query": {
                         "type": "string",
-                        "description": f"""
-                            Write a SQL query to extract the necessary information to answer the user's question.
-                            The query should use the following database schema:
-                            {databaseSchema_toString}
-                            Ensure that the SQL query is written in plain text and accurately reflects the schema provided.
-                        """,
+                        "description": "SQL query answering the user's question, using the schema from the system prompt",
                     },
                 },
                 "required": ["query"],
@@ -78,76 +105,276 @@ tools = [
         }
     }
 ]
-@st.cache_data
-def ask_database(query):
+# Results are cached under the query's canonical sqlglot form, so equivalent
+# spellings share one entry; key them with a single xxh3 pass over the string.
+# The underscore keeps the original query out of the key.
+@st.cache_data(hash_funcs={str: xxhash.xxh3_64_intdigest})
+def ask_database(query_key, _query):
     """Execute SQL query and return a DataFrame."""
-    with sqlite3.connect(db_url) as conn:
-        df = pd.read_sql_query(query, conn)
-    return df
-
-# Initialize the OpenAI client
-client = OpenAI(
-    api_key=api_key
-)
+    # Read through sqlite3, which keeps each value's stored type; ADBC fixes a
+    # column's Arrow type from the first rows and stringifies columns mixing types
+    with connect_lock:
+        return pd.read_sql_query(_query, connect)
+
+# Initialize the OpenAI client once per process, with an HTTP/2 keep-alive
+# pool, so reruns and sessions reuse open connections
+@st.cache_resource
+def get_openai_client():
+    return OpenAI(
+        api_key=api_key,
+        http_client=httpx.Client(
+            http2=True,
+            timeout=30.0,
+            limits=httpx.Limits(max_connections=200, max_keepalive_connections=50)
+        )
+    )
+
+client = get_openai_client()
 def get_sql_query(question):
     chat_completion = client.chat.completions.create(
         messages = [
             {
                 "role": "system",
-                "content": "Answer user questions by generating SQL queries",
+                "content": system_prompt,
             },
             {
                 "role": "user",
                 "content": question,
             }
         ],
-        model="gpt-4o-mini",
+        model=openai_model,
         tools=tools
     )
 
     message = chat_completion.choices[0].message
-    query = eval(message.tool_calls[0].function.arguments)['query']
+    # Parse the tool arguments as JSON; never eval model output
+    arguments = json.loads(message.tool_calls[0].function.arguments)
+    query = arguments['query']
     return query
 
+@st.cache_resource
+def get_sql_cache():
+    """SQL cache shared across Streamlit reruns and sessions, persisted across restarts"""
+    return SemanticCache(directory=os.getenv("SQL_CACHE_DIR", PERSISTENT_CACHE_DIR) or None)
+
+# Embeddings depend only on the question and model, so they are kept on disk too
+@st.cache_data(max_entries=1024, show_spinner=False, persist="disk")
+def fetch_embedding(normalized_question):
+    """Embed a normalized question through OpenAI"""
+    response = client.embeddings.create(model=EMBEDDING_MODEL, input=normalized_question)
+    return np.asarray(response.data[0].embedding, dtype=np.float32)
+
+def embed_question(question):
+    """
+    Embed a question for semantic cache lookups.
+    Returns None when the embedding request fails, which limits the cache to exact matches.
+    """
+    # Caught outside the cached function, so a failure is never cached
+    try:
+        return fetch_embedding(normalize_question(question))
+    except Exception:
+        return None
+
 st.title("Database Query App")
 
 question = st.text_input("Ask a question about the database:")
         
-def is_data_visualizable(df):
+def get_numeric_columns(df):
+    """Names of plottable numeric columns (any int/float width, including nullable types)."""
+    # Single pass over the dtypes; booleans count as numeric for pandas but are not plotted
+    return tuple(
+        column for column, dtype in df.dtypes.items()
+        if pd.api.types.is_numeric_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype)
+    )
+
+
+def is_data_visualizable(numeric_columns):
     """Check if data can produce at least one plot type."""
-    numeric_columns = df.select_dtypes(include=['int64', 'float64']).columns
     return len(numeric_columns) > 0, len(numeric_columns) > 1
 
 
-def generate_visualization(df, plot_type, placeholder):
-    """Generate visualization based on the plot type."""
-    numeric_columns = df.select_dtypes(include=['int64', 'float64']).columns
-    
+# Scatter plots with more points than this are drawn as a 2D density histogram
+DENSITY_PLOT_ROWS = 50_000
+DENSITY_BINS = 200
+# Slices of the points binned in parallel, each into its own partial grid. A
+# compile-time constant rather than numba.get_num_threads(), which would keep
+# the kernel out of Numba's on-disk cache
+DENSITY_CHUNKS = 16
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def bin2d(x, y, nx, ny, xmin, xmax, ymin, ymax):
+    """Count points per cell of an nx-by-ny grid spanning [xmin, xmax] x [ymin, ymax].
+
+    Points must be finite and inside the range. Each parallel iteration fills
+    its own partial grid over a contiguous slice of the points; the grids are
+    summed at the end.
+    """
+    n_chunks = DENSITY_CHUNKS
+    chunk = (x.size + n_chunks - 1) // n_chunks
+    partial = np.zeros((n_chunks, nx, ny), np.int64)
+    x_scale = nx / (xmax - xmin)
+    y_scale = ny / (ymax - ymin)
+    for c in prange(n_chunks):
+        for i in range(c * chunk, min((c + 1) * chunk, x.size)):
+            ix = min(int((x[i] - xmin) * x_scale), nx - 1)
+            iy = min(int((y[i] - ymin) * y_scale), ny - 1)
+            partial[c, ix, iy] += 1
+    counts = np.zeros((nx, ny), np.int64)
+    for c in range(n_chunks):
+        counts += partial[c]
+    return counts
+
+
+def plot_density(ax, x, y):
+    """Draw a 2D histogram of the points instead of scattering every one of them."""
+    finite = np.isfinite(x) & np.isfinite(y)
+    x, y = x[finite], y[finite]
+    if not x.size:
+        # Nothing to bin: leave the axes empty
+        return
+    xmin, xmax = x.min(), x.max()
+    ymin, ymax = y.min(), y.max()
+    # Widen degenerate ranges so every point falls into a cell
+    if xmax == xmin:
+        xmax = xmin + 1.0
+    if ymax == ymin:
+        ymax = ymin + 1.0
+    counts = bin2d(x, y, DENSITY_BINS, DENSITY_BINS, xmin, xmax, ymin, ymax)
+    image = ax.imshow(counts.T, origin="lower", extent=(xmin, xmax, ymin, ymax), aspect="auto")
+    ax.figure.colorbar(image, ax=ax, label="Points")
+
+
+def numeric_values(df, column):
+    """Column as a float64 array with missing values (including pd.NA) as NaN."""
+    return df[column].to_numpy(dtype=np.float64, na_value=np.nan)
+
+
+def hash_dataframe(df):
+    """Fast content hash of a DataFrame for Streamlit's cache"""
+    # Row hashes do not cover the column names, which end up in plot labels
+    columns = pd.util.hash_pandas_object(pd.Index(df.columns).astype(str), index=False)
+    return columns.values.tobytes() + pd.util.hash_pandas_object(df, index=True).values.tobytes()
+
+
+def generate_visualization(df, numeric_columns, plot_type):
+    """Generate visualization based on the plot type and return the figure."""
+    # Object-oriented API: no pyplot global state, each call owns its figure
+    fig = Figure(figsize=(10, 6))
+    ax = fig.subplots()
     if plot_type == "Bar Chart" and len(numeric_columns) > 0:
-        plt.figure(figsize=(10, 6))
-        df.plot(kind='bar', y=numeric_columns[0], ax=plt.gca())
-        plt.title(f'{numeric_columns[0]} by Index')
-        plt.tight_layout()
-        placeholder.pyplot(plt)
+        ax.bar(df.index, numeric_values(df, numeric_columns[0]))
+        ax.set_title(f'{numeric_columns[0]} by Index')
+    elif plot_type == "Scatter Plot" and len(numeric_columns) > 1 and len(df) > DENSITY_PLOT_ROWS:
+        # Columns as contiguous float64 buffers for the compiled kernel
+        plot_density(ax, numeric_values(df, numeric_columns[0]), numeric_values(df, numeric_columns[1]))
+        ax.set_xlabel(numeric_columns[0])
+        ax.set_ylabel(numeric_columns[1])
+        ax.set_title(f'{numeric_columns[1]} vs {numeric_columns[0]} (point density)')
     elif plot_type == "Scatter Plot" and len(numeric_columns) > 1:
-        plt.figure(figsize=(10, 6))
-        df.plot(kind='scatter', x=numeric_columns[0], y=numeric_columns[1], ax=plt.gca())
-        plt.title(f'{numeric_columns[1]} vs {numeric_columns[0]}')
-        plt.tight_layout()
-        placeholder.pyplot(plt)
+        ax.scatter(numeric_values(df, numeric_columns[0]), numeric_values(df, numeric_columns[1]))
+        ax.set_xlabel(numeric_columns[0])
+        ax.set_ylabel(numeric_columns[1])
+        ax.set_title(f'{numeric_columns[1]} vs {numeric_columns[0]}')
+    fig.tight_layout()
+    return fig
+
+
+# Rendered plots are cached on the data and plot type, so reruns (e.g. toggling
+# the plot type back and forth) skip drawing. The cache holds PNG bytes rather
+# than the Figure, which sessions on other threads would otherwise share.
+@st.cache_data(hash_funcs={pd.DataFrame: hash_dataframe}, max_entries=32, show_spinner=False)
+def render_visualization(df, numeric_columns, plot_type):
+    """Draw the visualization and return it as PNG bytes."""
+    buffer = io.BytesIO()
+    generate_visualization(df, numeric_columns, plot_type).savefig(buffer, format="png")
+    return buffer.getvalue()
+
+
 
+# Bar charts for questions asking for counts/rankings/breakdowns show per-group
+# totals instead of one bar per raw row
+AGGREGATION_KEYWORDS = re.compile(r"\b(top|count|per)\b|(?<!sorted )(?<!ordered )\bby\b", re.IGNORECASE)
+AGGREGATED_ROW_LIMIT = 10000
+# Scatter plots of larger results are drawn from a random sample of the rows,
+# up to DENSITY_PLOT_ROWS where the full data is binned instead
+SCATTER_SAMPLE_ROWS = 5000
+
+
+def is_identifier_column(name):
+    """Whether a column looks like a key, which is never summed."""
+    name = name.lower()
+    return name == "id" or name.endswith("_id")
+
+
+def bar_label(value):
+    """Tick label for a group key; NULL keys get a visible label of their own."""
+    return "(null)" if pd.isna(value) else str(value)
+
+
+def aggregate_for_bar_chart(results, sql_query, question, numeric_columns):
+    """
+    Group the query results feeding the bar chart when the question asks for an aggregate.
+
+    The first column becomes the group key, as string labels; the frame holds the
+    sum of every other column in `numeric_columns` (keys excluded), then a row
+    count. Returns None when the question does not ask for an aggregate, or when
+    the query already aggregates, is already ranked or limited, selects * or has
+    no FROM clause. The results table always shows the rows of the original query.
+    """
+    if not AGGREGATION_KEYWORDS.search(question) or not results.columns.is_unique:
+        return None
+    tree = sqlglot.parse_one(sql_query, read="sqlite")
+    if (
+        not isinstance(tree, exp.Select)
+        or len(tree.expressions) < 2
+        or tree.args.get("group") or tree.args.get("distinct")
+        or tree.args.get("order") or tree.args.get("limit")
+        or tree.find(exp.AggFunc, exp.Star)
+        or not tree.args.get("from")
+    ):
+        return None
+
+    # Grouped in pandas on the rows already loaded, rather than running the query again
+    key = results.columns[0]
+    measures = [name for name in results.columns[1:] if name in numeric_columns and not is_identifier_column(name)]
+    groups = results.groupby(key, dropna=False, sort=False)
+    # min_count=1: a group of only NULLs sums to NULL, as in SQL
+    aggregated = groups[measures].sum(min_count=1).add_prefix("sum_")
+    aggregated["row_count"] = groups.size()
+    aggregated = aggregated.head(AGGREGATED_ROW_LIMIT)
+    aggregated.index = aggregated.index.map(bar_label)
+    return aggregated
 
 
 if question:
     try:
-        sql_query = get_sql_query(question)  # Assume get_sql_query is defined elsewhere
-        results = ask_database(sql_query)
+        # Reuse the SQL of an identical or near-identical earlier question
+        sql_cache = get_sql_cache()
+        embedding = None
+        sql_query = sql_cache.get(question, databaseSchema_toString, openai_model)
+        exact_hit = sql_query is not None
+        if not exact_hit:
+            embedding = embed_question(question)
+            if embedding is not None:
+                sql_query = sql_cache.search(embedding, databaseSchema_toString, openai_model)
+        semantic_hit = not exact_hit and sql_query is not None
+        if sql_query is None:
+            sql_query = get_sql_query(question)
+        # Reject anything but a single SELECT before it reaches SQLite; the
+        # canonical form only keys the result cache, the model's text is what runs
+        results = ask_database(canonicalize_sql(sql_query), sql_query)
+        # Write through only once the query ran successfully
+        if not exact_hit:
+            sql_cache.put(question, databaseSchema_toString, openai_model, sql_query,
+                          None if semantic_hit else embedding)
         st.subheader("SQL Query:")
         st.code(sql_query, language="sql")
         st.subheader("Query Results:")
         st.dataframe(results)
         
-        can_plot_bar, can_plot_scatter = is_data_visualizable(results)
+        numeric_columns = get_numeric_columns(results)
+        can_plot_bar, can_plot_scatter = is_data_visualizable(numeric_columns)
         
         if can_plot_bar or can_plot_scatter:
             # Setup layout: columns for control and visualization
@@ -161,9 +388,14 @@ if question:
                 plot_type = st.radio("Select Plot Type:", plot_types)
 
             with col2:
-                generate_visualization(results, plot_type, col2)
+                plot_data, plot_columns = results, numeric_columns
+                aggregated = aggregate_for_bar_chart(results, sql_query, question, numeric_columns) if plot_type == "Bar Chart" else None
+                if aggregated is not None:
+                    # One bar per group, labelled by the group key
+                    plot_data, plot_columns = aggregated, get_numeric_columns(aggregated)
+                elif plot_type == "Scatter Plot" and SCATTER_SAMPLE_ROWS < len(results) <= DENSITY_PLOT_ROWS:
+                    # Fixed seed: reruns draw the same sample and reuse the cached plot
+                    plot_data = results.sample(SCATTER_SAMPLE_ROWS, random_state=0)
+                col2.image(render_visualization(plot_data, plot_columns, plot_type), use_column_width=True)
     except Exception as e:
         st.error(f"An error occurred: {str(e)}")
-
-# Close the database connection when the app is done
-connect.close()
\ No newline at end of file
@@ -6,22 +6,37 @@ translates them to SQL using OpenAI, executes them safely against a SQLite datab
 and returns structured JSON responses.
 """
 
+import asyncio
+import functools
+import itertools
 import logging
 import sqlite3
 import os
+import queue
+import threading
 import re
 import json
-from typing import Optional, List, Dict, Any
-from contextlib import contextmanager
-import pandas as pd
-from io import StringIO
+from typing import Optional, List, Dict, Any, Awaitable, Callable, Iterator, Tuple
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+import aiosqlite
+import httpx
+import numpy as np
+import orjson
+import pyarrow as pa
+import pyarrow.csv as pa_csv
 
 from fastapi import FastAPI, HTTPException, UploadFile, File
-from fastapi.responses import JSONResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel, Field
-from openai import OpenAI
+from openai import AsyncOpenAI
 from dotenv import load_dotenv
 
+from query_cache import (
+    EMBEDDING_MODEL, PERSISTENT_CACHE_DIR, SemanticCache, canonicalize_sql, normalize_question
+)
+
 # Configure logging to stdout
 logging.basicConfig(
     level=logging.INFO,
@@ -33,25 +48,104 @@ logger = logging.getLogger(__name__)
 # Load environment variables
 load_dotenv()
 
+# orjson options shared by regular and streamed responses: allow non-string
+# dict keys and encode numpy scalars/arrays natively
+ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+
+class ORJSONResponse(JSONResponse):
+    """JSON response rendered with orjson instead of the stdlib encoder"""
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, option=ORJSON_OPTIONS)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Application lifespan - releases pooled connections on shutdown"""
+    yield
+    await sql_batcher.stop()
+    await db_pool.close()
+    query_pool.close()
+    if openai_client:
+        await openai_client.close()
+    sql_cache.close()
+
+
 # Initialize FastAPI app
 app = FastAPI(
     title="Chat with Database API",
     description="API for querying databases using natural language",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
 # Configuration
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 DB_URL = os.getenv("DB_URL", "database.db")
+OPENAI_MODEL = "gpt-4o-mini"
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4"))
+# Concurrent translation requests are grouped into one chat completion:
+# up to SQL_BATCH_SIZE questions, waiting at most SQL_BATCH_MAX_WAIT_S
+SQL_BATCH_SIZE = int(os.getenv("SQL_BATCH_SIZE", "8"))
+SQL_BATCH_MAX_WAIT_S = float(os.getenv("SQL_BATCH_MAX_WAIT_S", "0.02"))
+# Directory of the persistent SQL cache; set it empty to keep the cache in memory only
+SQL_CACHE_DIR = os.getenv("SQL_CACHE_DIR", PERSISTENT_CACHE_DIR)
+# Results with more rows than STREAMING_ROW_THRESHOLD are streamed to the client
+# in chunks of RESULT_BATCH_ROWS instead of being materialized in one response
+STREAMING_ROW_THRESHOLD = 1000
+RESULT_BATCH_ROWS = 10_000
+# Row cap the model is asked to apply to generated queries
+QUERY_ROW_LIMIT = int(os.getenv("QUERY_ROW_LIMIT", "10000"))
+
+# Applied once when a pooled connection is opened, not on every request
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA cache_size=-65536",
+)
+# Set to "true" when OPENAI_BASE_URL points at an Anthropic-compatible provider
+# that needs explicit cache_control markers for prompt caching
+LLM_CACHE_CONTROL = os.getenv("LLM_CACHE_CONTROL", "false").lower() == "true"
+
+# Stable instructions placed in front of the schema in the system prompt.
+# The preamble + schema form the prompt prefix, so they must stay byte-identical
+# between requests for the provider-side prompt cache to hit.
+SQL_SYSTEM_PREAMBLE = (
+    "Answer user questions by generating SQL queries. "
+    "Write a SQL query to extract the necessary information to answer the user's question. "
+    "The query should use the database schema below. "
+    "Ensure that the SQL query is written in plain text and accurately reflects the schema provided. "
+    f"Unless the user asks for a specific number of rows, limit the result to at most {QUERY_ROW_LIMIT} rows."
+)
+
+# Valid table names: letters, digits and underscores, not starting with a digit
+_IDENT = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
 
 # Initialize OpenAI client
 openai_client = None
 if OPENAI_API_KEY:
-    openai_client = OpenAI(api_key=OPENAI_API_KEY)
+    # One HTTP/2 client with a keep-alive pool shared by all requests, so calls
+    # reuse open TLS connections instead of handshaking each time
+    openai_client = AsyncOpenAI(
+        api_key=OPENAI_API_KEY,
+        http_client=httpx.AsyncClient(
+            http2=True,
+            timeout=30.0,
+            limits=httpx.Limits(max_connections=200, max_keepalive_connections=50)
+        )
+    )
     logger.info("OpenAI client initialized successfully")
 else:
     logger.warning("OPENAI_API_KEY not found. Natural language to SQL translation will not work.")
 
+# Cache of generated SQL, shared by all requests handled by this process and
+# persisted to disk so restarts and other workers start warm
+sql_cache = SemanticCache(directory=SQL_CACHE_DIR or None)
+
 
 # Pydantic models for request/response
 class ChatRequest(BaseModel):
@@ -85,64 +179,433 @@ class ChatResponse(BaseModel):
 
 
 # Database utility functions
-@contextmanager
-def get_db_connection():
-    """Context manager for database connections"""
-    conn = None
+async def open_sqlite_connection() -> aiosqlite.Connection:
+    """Open and configure an aiosqlite connection for the pool"""
+    conn = await aiosqlite.connect(DB_URL)
+    conn.row_factory = sqlite3.Row  # Enable column access by name
+    for pragma in SQLITE_PRAGMAS:
+        await conn.execute(pragma)
+    logger.info(f"Opened pooled connection to database: {DB_URL}")
+    return conn
+
+
+def open_query_connection() -> sqlite3.Connection:
+    """
+    Open and configure a sqlite3 connection for running generated queries and
+    loading uploaded CSV files. Result generators may be resumed from different
+    threadpool threads.
+    """
+    conn = sqlite3.connect(DB_URL, check_same_thread=False)
+    for pragma in SQLITE_PRAGMAS:
+        conn.execute(pragma)
+    logger.info(f"Opened pooled query connection to database: {DB_URL}")
+    return conn
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of persistent database connections.
+
+    Connections are opened lazily up to `size` and configured once, so requests
+    skip the connect/PRAGMA setup cost. Checked-out connections are returned to
+    the pool instead of being closed.
+    """
+
+    def __init__(self, open_connection: Callable[[], Any], size: int):
+        self._open = open_connection
+        self.size = size
+        self._idle: queue.LifoQueue = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _acquire(self) -> Any:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            can_open = self._created < self.size
+            if can_open:
+                self._created += 1
+        if can_open:
+            try:
+                return self._open()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        return self._idle.get()
+
+    @contextmanager
+    def connection(self):
+        """Check a connection out of the pool for the duration of the block"""
+        conn = self._acquire()
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            self._idle.put(conn)
+
+    def close(self) -> None:
+        """Close all idle connections"""
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+        logger.info("Database connection pool closed")
+
+
+class AsyncConnectionPool:
+    """
+    Pool of persistent aiosqlite connections for use from the event loop.
+
+    Same contract as ConnectionPool, but waiting for a free connection
+    suspends the request instead of blocking the worker.
+    """
+
+    def __init__(self, open_connection: Callable[[], Awaitable[Any]], size: int):
+        self._open = open_connection
+        self.size = size
+        self._idle: asyncio.LifoQueue = asyncio.LifoQueue()
+        self._created = 0
+
+    async def _acquire(self) -> Any:
+        if self._idle.empty() and self._created < self.size:
+            self._created += 1
+            try:
+                return await self._open()
+            except Exception:
+                self._created -= 1
+                raise
+        return await self._idle.get()
+
+    @asynccontextmanager
+    async def connection(self):
+        """Check a connection out of the pool for the duration of the block"""
+        conn = await self._acquire()
+        try:
+            yield conn
+        except BaseException:
+            await conn.rollback()
+            raise
+        finally:
+            self._idle.put_nowait(conn)
+
+    async def close(self) -> None:
+        """Close all idle connections"""
+        while not self._idle.empty():
+            conn = self._idle.get_nowait()
+            await conn.close()
+            self._created -= 1
+        logger.info("Database connection pool closed")
+
+
+db_pool = AsyncConnectionPool(open_sqlite_connection, DB_POOL_SIZE)
+query_pool = ConnectionPool(open_query_connection, DB_POOL_SIZE)
+
+
+@asynccontextmanager
+async def get_db_connection():
+    """Async context manager that checks a connection out of the database pool"""
     try:
-        conn = sqlite3.connect(DB_URL)
-        conn.row_factory = sqlite3.Row  # Enable column access by name
-        logger.info(f"Connected to database: {DB_URL}")
-        yield conn
+        async with db_pool.connection() as conn:
+            yield conn
     except sqlite3.Error as e:
         logger.error(f"Database connection error: {e}")
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
-    finally:
-        if conn:
-            conn.close()
-            logger.info("Database connection closed")
 
 
-def get_table_names(conn: sqlite3.Connection) -> List[str]:
-    """Get all table names from the database"""
+async def get_database_schema(conn: aiosqlite.Connection) -> List[Dict[str, Any]]:
+    """
+    Get information about all tables and their columns in the database.
+    Uses a single query joining sqlite_master with the pragma_table_info
+    table-valued function instead of one PRAGMA per table.
+    """
     try:
-        cursor = conn.execute("SELECT name FROM sqlite_master WHERE type='table';")
-        table_names = [row[0] for row in cursor.fetchall()]
-        logger.info(f"Found {len(table_names)} tables: {table_names}")
-        return table_names
+        cursor = await conn.execute(
+            "SELECT m.name AS table_name, p.name AS column_name "
+            "FROM sqlite_master m JOIN pragma_table_info(m.name) p "
+            "WHERE m.type='table' ORDER BY m.name, p.cid;"
+        )
+        table_dicts = [
+            {"table_name": table_name, "column_names": [row[1] for row in rows]}
+            for table_name, rows in itertools.groupby(await cursor.fetchall(), key=lambda row: row[0])
+        ]
+        logger.info(f"Found {len(table_dicts)} tables: {[t['table_name'] for t in table_dicts]}")
+        return table_dicts
     except sqlite3.Error as e:
-        logger.error(f"Error fetching table names: {e}")
+        logger.error(f"Error fetching database schema: {e}")
         return []
 
 
-def get_column_names(conn: sqlite3.Connection, table_name: str) -> List[str]:
-    """Get all column names for a specific table"""
-    try:
-        # Validate table name to prevent SQL injection
-        if not re.match(r'^[a-zA-Z0-9_]+$', table_name):
-            logger.error(f"Invalid table name: {table_name}")
-            return []
-        cursor = conn.execute(f"PRAGMA table_info('{table_name}');")
-        column_names = [row[1] for row in cursor.fetchall()]
-        logger.info(f"Table '{table_name}' has columns: {column_names}")
-        return column_names
-    except sqlite3.Error as e:
-        logger.error(f"Error fetching column names for table '{table_name}': {e}")
-        return []
+# Prompt schema strings keyed by SQLite's schema cookie (PRAGMA schema_version),
+# which changes whenever a table is created, altered or dropped
+SCHEMA_CACHE_SIZE = 4
+_schema_strings: "OrderedDict[int, str]" = OrderedDict()
+
+
+def build_schema_string(schema: List[Dict[str, Any]]) -> str:
+    """Format the database schema for the LLM prompt"""
+    return "\n".join(
+        f"Table: {table['table_name']}\nColumns: {', '.join(table['column_names'])}"
+        for table in schema
+    )
+
+
+async def get_schema_string() -> str:
+    """
+    Return the prompt schema string, rebuilding it only when the schema version changes.
+    Reusing the same string also keeps the LLM prompt prefix stable for prompt caching.
+    """
+    async with get_db_connection() as conn:
+        cursor = await conn.execute("PRAGMA schema_version")
+        schema_version = (await cursor.fetchone())[0]
+        schema_str = _schema_strings.get(schema_version)
+        if schema_str is not None:
+            _schema_strings.move_to_end(schema_version)
+            return schema_str
+        schema_str = build_schema_string(await get_database_schema(conn))
+
+    _schema_strings[schema_version] = schema_str
+    while len(_schema_strings) > SCHEMA_CACHE_SIZE:
+        _schema_strings.popitem(last=False)
+    logger.info(f"Built schema string for schema version {schema_version}")
+    return schema_str
 
 
-def get_database_schema(conn: sqlite3.Connection) -> List[Dict[str, Any]]:
-    """Get information about all tables and their columns in the database"""
-    table_dicts = []
-    for table_name in get_table_names(conn):
-        column_names = get_column_names(conn, table_name)
-        table_dicts.append({"table_name": table_name, "column_names": column_names})
-    return table_dicts
+@functools.lru_cache(maxsize=SCHEMA_CACHE_SIZE)
+def build_schema_message(database_schema: str) -> Dict[str, Any]:
+    """
+    Build the system message carrying the database schema.
+
+    The schema sits at the very front of the prompt so it forms a cacheable prefix;
+    the user's question always comes after it. Memoized per schema string, so every
+    request sends the exact same message object; callers must not mutate it.
+    """
+    content = f"{SQL_SYSTEM_PREAMBLE}\n\nDatabase schema:\n{database_schema}"
+    if LLM_CACHE_CONTROL:
+        return {
+            "role": "system",
+            "content": [
+                {"type": "text", "text": content, "cache_control": {"type": "ephemeral"}}
+            ],
+        }
+    return {"role": "system", "content": content}
+
+
+# Tool definitions are built once at import and kept as tuples so they cannot be
+# mutated; the schema lives in the system message, not in the tools
+SQL_QUERY_TOOLS = (
+    {
+        "type": "function",
+        "function": {
+            "name": "ask_database",
+            "description": "Use this function to answer a question about the database",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "query": {
+                        "type": "string",
+                        "description": "SQL query answering the user's question, using the schema from the system prompt",
+                    },
+                },
+                "required": ["query"],
+            },
+        }
+    },
+)
+
+SQL_BATCH_TOOLS = (
+    {
+        "type": "function",
+        "function": {
+            "name": "ask_database_batch",
+            "description": "Use this function to answer several numbered questions about the database",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "queries": {
+                        "type": "array",
+                        "items": {
+                            "type": "object",
+                            "properties": {
+                                "idx": {
+                                    "type": "integer",
+                                    "description": "Number of the question this query answers",
+                                },
+                                "query": {
+                                    "type": "string",
+                                    "description": "SQL query answering that question, using the schema from the system prompt",
+                                },
+                            },
+                            "required": ["idx", "query"],
+                        },
+                    },
+                },
+                "required": ["queries"],
+            },
+        }
+    },
+)
+
+
+async def request_sql_query(question: str, database_schema: str) -> Optional[str]:
+    """
+    Ask OpenAI for the SQL query answering a single question.
+    Returns None if the model did not produce a query; API errors propagate.
+    """
+    chat_completion = await openai_client.chat.completions.create(
+        # Schema first, question last: keeps the cacheable prefix invariant
+        messages=[
+            build_schema_message(database_schema),
+            {
+                "role": "user",
+                "content": question,
+            }
+        ],
+        model=OPENAI_MODEL,
+        tools=SQL_QUERY_TOOLS
+    )
+    
+    message = chat_completion.choices[0].message
+    if message.tool_calls and len(message.tool_calls) > 0:
+        # Safely parse JSON instead of using eval()
+        arguments = json.loads(message.tool_calls[0].function.arguments)
+        return arguments['query']
+    return None
+
+
+async def request_sql_queries(questions: List[str], database_schema: str) -> Dict[int, str]:
+    """
+    Ask OpenAI for SQL queries answering several questions in one chat completion.
+    Returns a mapping from question index to query; questions the model skipped are missing.
+    """
+    numbered_questions = "\n".join(
+        f"{idx}. {' '.join(question.split())}" for idx, question in enumerate(questions, start=1)
+    )
+    
+    chat_completion = await openai_client.chat.completions.create(
+        # Same cacheable schema prefix as single requests; only the question block differs
+        messages=[
+            build_schema_message(database_schema),
+            {
+                "role": "user",
+                "content": f"Write one SQL query for each of the following questions:\n{numbered_questions}",
+            }
+        ],
+        model=OPENAI_MODEL,
+        tools=SQL_BATCH_TOOLS,
+        tool_choice={"type": "function", "function": {"name": "ask_database_batch"}}
+    )
+    
+    message = chat_completion.choices[0].message
+    if not message.tool_calls:
+        return {}
+    arguments = json.loads(message.tool_calls[0].function.arguments)
+    return {
+        item["idx"] - 1: item["query"]
+        for item in arguments.get("queries", [])
+        if isinstance(item.get("idx"), int) and 1 <= item["idx"] <= len(questions) and item.get("query")
+    }
 
 
-def generate_sql_query(question: str, database_schema: str) -> str:
+class SQLQueryBatcher:
+    """
+    Micro-batches concurrent translation requests.
+
+    Requests are queued with a future; a background task drains up to
+    `max_batch` of them, waiting at most `max_wait_s` after the first, and sends
+    each group sharing a schema as one chat completion. Results are fanned out
+    through the futures. Single requests, and any question a batch call fails to
+    answer, go through the single-question path.
+    """
+
+    def __init__(self, max_batch: int, max_wait_s: float):
+        self.max_batch = max_batch
+        self.max_wait_s = max_wait_s
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._pending: set = set()  # Strong references to in-flight translations
+
+    async def submit(self, question: str, database_schema: str) -> Optional[str]:
+        """Queue a question and wait for its SQL query"""
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((question, database_schema, future))
+        return await future
+
+    async def stop(self) -> None:
+        """Stop the background task and cancel in-flight translations"""
+        tasks = list(self._pending)
+        if self._worker is not None:
+            tasks.append(self._worker)
+            self._worker = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait_s
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            
+            groups: Dict[str, List[Tuple[str, asyncio.Future]]] = {}
+            for question, database_schema, future in batch:
+                groups.setdefault(database_schema, []).append((question, future))
+            for database_schema, items in groups.items():
+                task = asyncio.create_task(self._translate(items, database_schema))
+                self._pending.add(task)
+                task.add_done_callback(self._pending.discard)
+
+    async def _translate(self, items: List[Tuple[str, asyncio.Future]], database_schema: str) -> None:
+        queries: Dict[int, str] = {}
+        if len(items) > 1:
+            try:
+                logger.info(f"Generating SQL queries for a batch of {len(items)} questions")
+                queries = await request_sql_queries([question for question, _ in items], database_schema)
+            except Exception as e:
+                logger.warning(f"Batched SQL generation failed: {e}. Retrying questions individually.")
+        
+        async def resolve(idx: int, question: str, future: asyncio.Future) -> None:
+            try:
+                query = queries.get(idx)
+                if query is None:
+                    query = await request_sql_query(question, database_schema)
+                if not future.done():
+                    future.set_result(query)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+        
+        await asyncio.gather(*(
+            resolve(idx, question, future) for idx, (question, future) in enumerate(items)
+        ))
+
+
+sql_batcher = SQLQueryBatcher(SQL_BATCH_SIZE, SQL_BATCH_MAX_WAIT_S)
+
+
+async def generate_sql_query(question: str, database_schema: str) -> str:
     """
     Generate SQL query from natural language using OpenAI.
+    Concurrent calls are batched into shared chat completions.
     Falls back to a basic query if OpenAI is not available.
     """
     if not openai_client:
@@ -152,52 +615,8 @@ def generate_sql_query(question: str, database_schema: str) -> str:
     
     try:
         logger.info(f"Generating SQL query for question: {question}")
-        
-        tools = [
-            {
-                "type": "function",
-                "function": {
-                    "name": "ask_database",
-                    "description": "Use this function to answer a question about the database",
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "query": {
-                                "type": "string",
-                                "description": f"""
-                                    Write a SQL query to extract the necessary information to answer the user's question.
-                                    The query should use the following database schema:
-                                    {database_schema}
-                                    Ensure that the SQL query is written in plain text and accurately reflects the schema provided.
-                                """,
-                            },
-                        },
-                        "required": ["query"],
-                    },
-                }
-            }
-        ]
-        
-        chat_completion = openai_client.chat.completions.create(
-            messages=[
-                {
-                    "role": "system",
-                    "content": "Answer user questions by generating SQL queries",
-                },
-                {
-                    "role": "user",
-                    "content": question,
-                }
-            ],
-            model="gpt-4o-mini",
-            tools=tools
-        )
-        
-        message = chat_completion.choices[0].message
-        if message.tool_calls and len(message.tool_calls) > 0:
-            # Safely parse JSON instead of using eval()
-            arguments = json.loads(message.tool_calls[0].function.arguments)
-            query = arguments['query']
+        query = await sql_batcher.submit(question, database_schema)
+        if query:
             logger.info(f"Generated SQL query: {query}")
             return query
         else:
@@ -209,6 +628,36 @@ def generate_sql_query(question: str, database_schema: str) -> str:
         return generate_fallback_query(question, database_schema)
 
 
+# Question embeddings keyed by normalized question, so repeated questions and
+# cache write-through share one embeddings API call
+EMBEDDING_CACHE_SIZE = 1024
+_question_embeddings: "OrderedDict[str, np.ndarray]" = OrderedDict()
+
+
+async def embed_question(question: str) -> Optional[np.ndarray]:
+    """
+    Embed a question for semantic cache lookups.
+    Returns None when OpenAI is not available, which limits the cache to exact matches.
+    """
+    if not openai_client:
+        return None
+    normalized_question = normalize_question(question)
+    embedding = _question_embeddings.get(normalized_question)
+    if embedding is not None:
+        _question_embeddings.move_to_end(normalized_question)
+        return embedding
+    try:
+        response = await openai_client.embeddings.create(model=EMBEDDING_MODEL, input=normalized_question)
+    except Exception as e:
+        logger.warning(f"Error embedding question: {e}. Using exact-match cache only.")
+        return None
+    embedding = np.asarray(response.data[0].embedding, dtype=np.float32)
+    _question_embeddings[normalized_question] = embedding
+    while len(_question_embeddings) > EMBEDDING_CACHE_SIZE:
+        _question_embeddings.popitem(last=False)
+    return embedding
+
+
 def generate_fallback_query(question: str, database_schema: str) -> str:
     """
     Generate a basic SQL query when OpenAI is not available.
@@ -250,31 +699,196 @@ def generate_fallback_query(question: str, database_schema: str) -> str:
     return query
 
 
-def execute_query(conn: sqlite3.Connection, query: str) -> List[Dict[str, Any]]:
+def decode_blobs(rows: List[Dict[str, Any]], columns: List[str]) -> List[Dict[str, Any]]:
     """
-    Execute SQL query safely and return results as a list of dictionaries.
+    Decode BLOB values in `columns` as UTF-8 in place, replacing invalid bytes,
+    so regular and streamed responses encode them the same way.
+    """
+    for row in rows:
+        for name in columns:
+            value = row[name]
+            if isinstance(value, bytes):
+                row[name] = value.decode("utf-8", errors="replace")
+    return rows
+
+
+def execute_query(query: str) -> Iterator[List[Dict[str, Any]]]:
+    """
+    Execute SQL query safely and yield the result rows as dicts, in chunks of at
+    most RESULT_BATCH_ROWS rows, so large results never have to be held in memory
+    at once. The pooled connection stays checked out until the generator is
+    exhausted or closed. Execution errors raise HTTPException(400) on the
+    iteration that hits them.
+    
+    Rows are read through sqlite3, which returns every value with the type SQLite
+    stored it as. ADBC is not used here: it fixes each column's Arrow type from
+    the first rows, and columns mixing types come back as strings or fail.
     
     Note: The query parameter comes from either OpenAI API or our generate_fallback_query
-    function, not directly from user input. We validate it only allows SELECT/PRAGMA
-    queries to prevent any potential data modification.
-    """
-    # Basic validation: only allow SELECT, PRAGMA queries for safety
-    query_upper = query.strip().upper()
-    if not (query_upper.startswith('SELECT') or query_upper.startswith('PRAGMA')):
-        logger.error(f"Rejected non-SELECT query: {query}")
-        raise HTTPException(status_code=400, detail="Only SELECT queries are allowed")
+    function, not directly from user input, and must already have been validated
+    with canonicalize_sql, which only allows a single SELECT statement.
+    """
+    with query_pool.connection() as conn:
+        cursor = conn.cursor()
+        try:
+            logger.info(f"Executing query: {query}")
+            cursor.execute(query)
+            columns = [column[0] for column in cursor.description]
+            while True:
+                rows = cursor.fetchmany(RESULT_BATCH_ROWS)
+                if not rows:
+                    break
+                yield decode_blobs([dict(zip(columns, row)) for row in rows], columns)
+        except sqlite3.Error as e:
+            logger.error(f"Error executing query: {e}")
+            raise HTTPException(status_code=400, detail="Query execution error")
+        finally:
+            # Finalizes the statement, releasing its read snapshot
+            cursor.close()
+
+
+def read_result_head(chunks: Iterator[List[Dict[str, Any]]], max_rows: int) -> Tuple[List[Dict[str, Any]], bool]:
+    """
+    Read row chunks until more than `max_rows` rows were read or the result ends.
+    Returns the rows read and whether the result was fully consumed.
+    """
+    head = []
+    for rows in chunks:
+        head.extend(rows)
+        if len(head) > max_rows:
+            return head, False
+    return head, True
+
+
+def stream_chat_response(
+    sql_query: str,
+    head: List[Dict[str, Any]],
+    chunks: Iterator[List[Dict[str, Any]]],
+    on_complete: Optional[Callable[[], None]] = None
+) -> Iterator[bytes]:
+    """
+    Encode a ChatResponse-shaped JSON document chunk by chunk.
+    `message` and `row_count` come last since the row count is only known at the end.
     
+    Headers are already sent when a later chunk fails to read, so the document is
+    closed with the rows sent so far and an `error` field. `on_complete` runs only
+    once every row was sent.
+    """
+    yield b'{"sql_query":' + orjson.dumps(sql_query) + b',"results":['
+    row_count = 0
+    error = None
     try:
-        logger.info(f"Executing query: {query}")
-        # Query is safe: generated by OpenAI/fallback function and validated above
-        cursor = conn.execute(query)
-        columns = [description[0] for description in cursor.description]
-        results = [dict(zip(columns, row)) for row in cursor.fetchall()]
-        logger.info(f"Query executed successfully. Returned {len(results)} rows.")
-        return results
-    except sqlite3.Error as e:
-        logger.error(f"Error executing query: {e}")
-        raise HTTPException(status_code=400, detail="Query execution error")
+        for rows in itertools.chain([head], chunks):
+            if not rows:
+                continue
+            # Serialize the whole chunk at once and strip the enclosing brackets
+            encoded = orjson.dumps(rows, option=ORJSON_OPTIONS)[1:-1]
+            yield (b',' if row_count else b'') + encoded
+            row_count += len(rows)
+    except HTTPException as e:
+        error = e.detail
+    except Exception as e:
+        logger.error(f"Error streaming query results: {e}")
+        error = "Query execution error"
+    finally:
+        chunks.close()
+    
+    tail = b'],"row_count":' + str(row_count).encode()
+    if error is not None:
+        logger.error(f"Streamed response aborted after {row_count} rows")
+        message = f"Query failed after {row_count} result(s)."
+        tail += b',"error":' + orjson.dumps(error)
+    else:
+        logger.info(f"Streamed response with {row_count} rows")
+        message = f"Found {row_count} result(s) for your query."
+        if on_complete is not None:
+            on_complete()
+    yield tail + b',"message":' + orjson.dumps(message) + b'}'
+
+
+def dedupe_column_names(names: List[str]) -> List[str]:
+    """
+    Rename repeated column names to name.1, name.2, ... as pandas does, skipping
+    suffixes that are already taken by another column.
+    """
+    taken = set(names)
+    seen = set()
+    counts: Dict[str, int] = {}
+    result = []
+    for name in names:
+        candidate = name
+        if name in seen:
+            while candidate in taken:
+                counts[name] = counts.get(name, 0) + 1
+                candidate = f"{name}.{counts[name]}"
+            taken.add(candidate)
+        seen.add(candidate)
+        result.append(candidate)
+    return result
+
+
+def quote_identifier(name: str) -> str:
+    """Quote a column or table name for SQLite"""
+    return '"' + name.replace('"', '""') + '"'
+
+
+def sqlite_column_type(data_type: pa.DataType) -> str:
+    """SQLite column type for an Arrow type, as pandas to_sql declares them"""
+    if pa.types.is_integer(data_type) or pa.types.is_boolean(data_type):
+        return "INTEGER"
+    # All-empty columns come back as the null type; pandas reads them as float
+    if pa.types.is_floating(data_type) or pa.types.is_null(data_type):
+        return "REAL"
+    return "TEXT"
+
+
+def load_csv(content: bytes, table_name: str) -> pa.Table:
+    """
+    Parse CSV bytes and load them into `table_name`, replacing any existing table.
+    Returns the parsed Arrow table. Raises ValueError if the file is not UTF-8.
+    """
+    # Arrow does not validate the encoding: invalid fields would be stored as
+    # BLOBs, and invalid bytes in the header row abort the process
+    try:
+        content.decode("utf-8")
+    except UnicodeDecodeError as e:
+        raise ValueError("CSV file must be UTF-8 encoded") from e
+    
+    # Parse the raw bytes with Arrow's multithreaded CSV reader (no decode/copy);
+    # empty fields become NULL, as with pandas
+    convert_options = pa_csv.ConvertOptions(strings_can_be_null=True)
+    table = pa_csv.read_csv(pa.BufferReader(content), convert_options=convert_options)
+    # Arrow infers dates, times and timestamps, which would be stored reformatted
+    # (2024-01-01 10:00:00 as 2024-01-01T10:00:00); read those columns again as text
+    temporal_columns = [field.name for field in table.schema if pa.types.is_temporal(field.type)]
+    if temporal_columns:
+        convert_options.column_types = {name: pa.string() for name in temporal_columns}
+        table = pa_csv.read_csv(pa.BufferReader(content), convert_options=convert_options)
+    # Empty headers are named as pandas names them; SQLite rejects repeated column names
+    names = [name or f"Unnamed: {i}" for i, name in enumerate(table.column_names)]
+    table = table.rename_columns(dedupe_column_names(names))
+    logger.info(f"CSV parsed successfully. Shape: ({table.num_rows}, {table.num_columns})")
+    
+    # Create table in database. Written through sqlite3 rather than ADBC ingest:
+    # the ADBC driver links its own copy of SQLite, and two copies in one process
+    # drop each other's file locks, which corrupts the database.
+    # table_name is validated by the caller; replacing happens in one transaction.
+    table_sql = quote_identifier(table_name)
+    columns_sql = ", ".join(
+        f"{quote_identifier(field.name)} {sqlite_column_type(field.type)}" for field in table.schema
+    )
+    insert_sql = f"INSERT INTO {table_sql} VALUES ({', '.join('?' * table.num_columns)})"
+    with query_pool.connection() as conn:
+        conn.execute("BEGIN")
+        conn.execute(f"DROP TABLE IF EXISTS {table_sql}")
+        conn.execute(f"CREATE TABLE {table_sql} ({columns_sql})")
+        # Rows are converted one batch at a time to bound memory
+        for batch in table.to_batches(max_chunksize=RESULT_BATCH_ROWS):
+            conn.executemany(insert_sql, zip(*(column.to_pylist() for column in batch.columns)))
+        conn.commit()
+    
+    logger.info(f"Table '{table_name}' created with {table.num_rows} rows")
+    return table
 
 
 # API Endpoints
@@ -301,8 +915,8 @@ async def health():
     # Check database connection
     db_status = "connected"
     try:
-        with get_db_connection() as conn:
-            conn.execute("SELECT 1")
+        async with get_db_connection() as conn:
+            await conn.execute("SELECT 1")
     except Exception as e:
         db_status = "error"
         logger.error(f"Health check failed: {e}")
@@ -327,32 +941,72 @@ async def chat(request: ChatRequest):
     logger.info(f"Received chat request: {request.message}")
     
     try:
-        with get_db_connection() as conn:
-            # Get database schema
-            schema = get_database_schema(conn)
-            schema_str = "\n".join(
-                f"Table: {table['table_name']}\nColumns: {', '.join(table['column_names'])}"
-                for table in schema
-            )
-            
+        # Get database schema (cached until the schema version changes)
+        schema_str = await get_schema_string()
+        
+        # Look up a cached translation: exact repeat first (the disk layer is read
+        # off the event loop), then a near-duplicate. The question is only embedded
+        # on an exact miss, so repeats never wait for the embeddings API
+        sql_query = await run_in_threadpool(sql_cache.get, request.message, schema_str, OPENAI_MODEL)
+        exact_hit = sql_query is not None
+        embedding = None
+        if not exact_hit:
+            embedding = await embed_question(request.message)
+            if embedding is not None:
+                sql_query = sql_cache.search(embedding, schema_str, OPENAI_MODEL)
+        
+        semantic_hit = not exact_hit and sql_query is not None
+        if sql_query is not None:
+            logger.info(f"Using cached SQL query: {sql_query}")
+        else:
             # Generate SQL query from natural language
-            sql_query = generate_sql_query(request.message, schema_str)
-            
-            # Execute query
-            results = execute_query(conn, sql_query)
-            
-            # Prepare response
-            row_count = len(results)
-            response_message = f"Found {row_count} result(s) for your query."
-            
-            logger.info(f"Returning response with {row_count} rows")
-            
-            return ChatResponse(
-                message=response_message,
-                sql_query=sql_query,
-                results=results,
-                row_count=row_count
+            sql_query = await generate_sql_query(request.message, schema_str)
+        
+        # Validate the query before it reaches SQLite. The model's own text is what
+        # runs and gets cached: sqlglot's rendering can change semantics
+        # (json_extract becomes ->, which returns JSON text)
+        try:
+            canonicalize_sql(sql_query)
+        except ValueError as e:
+            logger.error(f"Rejected SQL query: {sql_query} ({e})")
+            raise HTTPException(status_code=400, detail=str(e))
+        
+        # Execute query off the event loop, reading just enough rows to decide
+        # between a regular and a streamed response
+        chunks = execute_query(sql_query)
+        head, complete = await run_in_threadpool(read_result_head, chunks, STREAMING_ROW_THRESHOLD)
+        
+        # Write through only once every row of the query was read successfully;
+        # runs in a worker thread, as the disk layer does blocking I/O
+        def cache_query() -> None:
+            if openai_client and not exact_hit:
+                sql_cache.put(
+                    request.message, schema_str, OPENAI_MODEL, sql_query,
+                    None if semantic_hit else embedding
+                )
+        
+        if not complete:
+            logger.info(f"Streaming response for more than {STREAMING_ROW_THRESHOLD} rows")
+            return StreamingResponse(
+                stream_chat_response(sql_query, head, chunks, cache_query),
+                media_type="application/json"
             )
+        
+        await run_in_threadpool(cache_query)
+        
+        # Prepare response
+        results = head
+        row_count = len(results)
+        response_message = f"Found {row_count} result(s) for your query."
+        
+        logger.info(f"Returning response with {row_count} rows")
+        
+        return ChatResponse(
+            message=response_message,
+            sql_query=sql_query,
+            results=results,
+            row_count=row_count
+        )
             
     except HTTPException:
         raise
@@ -371,34 +1025,26 @@ async def upload_csv(file: UploadFile = File(...), table_name: str = "uploaded_d
     logger.info(f"Received CSV upload: {file.filename}, target table: {table_name}")
     
     # Validate table name to prevent SQL injection
-    if not re.match(r'^[a-zA-Z0-9_]+$', table_name):
+    if not _IDENT.fullmatch(table_name):
         logger.error(f"Invalid table name: {table_name}")
-        raise HTTPException(status_code=400, detail="Invalid table name. Use only letters, numbers, and underscores.")
+        raise HTTPException(
+            status_code=400,
+            detail="Invalid table name. Use only letters, numbers, and underscores, and do not start with a number."
+        )
     
     try:
         # Read CSV content
         content = await file.read()
-        csv_string = content.decode('utf-8')
         
-        # Parse CSV using pandas
-        df = pd.read_csv(StringIO(csv_string))
-        logger.info(f"CSV parsed successfully. Shape: {df.shape}")
+        # Parsing and ingest are blocking, so they run in the threadpool
+        table = await run_in_threadpool(load_csv, content, table_name)
         
-        # Create table in database
-        with get_db_connection() as conn:
-            # pandas to_sql safely handles table creation with if_exists='replace'
-            # This avoids the need for DROP TABLE which could be vulnerable
-            df.to_sql(table_name, conn, index=False, if_exists='replace')
-            conn.commit()
-            
-            logger.info(f"Table '{table_name}' created with {len(df)} rows")
-            
-            return {
-                "message": f"CSV uploaded successfully",
-                "table_name": table_name,
-                "rows": len(df),
-                "columns": list(df.columns)
-            }
+        return {
+            "message": f"CSV uploaded successfully",
+            "table_name": table_name,
+            "rows": table.num_rows,
+            "columns": table.column_names
+        }
             
     except Exception as e:
         logger.error(f"Error uploading CSV: {e}")
@@ -0,0 +1,218 @@
+"""
+In-process cache for natural language to SQL translations.
+
+Shared by the FastAPI service (main.py) and the Streamlit app (app.py).
+Exact repeats of a question are served from an LRU keyed on the
+whitespace-collapsed question, the schema and the model. Near-duplicate questions are matched by
+cosine similarity of their embeddings, so rephrasings reuse the cached SQL
+instead of paying for another chat completion.
+
+Translations are also written to an optional diskcache directory so they
+survive process restarts (Streamlit reruns, uvicorn reloads); the disk layer is
+process-safe, so several workers can share one directory.
+
+Generated SQL is validated and canonicalized with sqlglot before it is executed
+or cached, so equivalent spellings of a query share one cache entry.
+"""
+
+import functools
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import sqlglot
+import xxhash
+from diskcache import Cache
+from sqlglot import exp
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+
+# Default location of the persistent translation cache, relative to the working directory
+PERSISTENT_CACHE_DIR = ".cache/nl2sql"
+
+
+# Statements that must not appear anywhere in a generated query, e.g. inside a CTE
+_WRITE_EXPRESSIONS = (exp.Insert, exp.Update, exp.Delete, exp.Drop, exp.Create, exp.Command)
+
+
+def canonicalize_sql(query: str) -> str:
+    """
+    Parse a generated query once and return it in canonical SQLite form.
+    Raises ValueError unless it is a single read-only SELECT statement, so
+    invalid or unsafe SQL is rejected before it reaches SQLite.
+    The canonical form is only fit as a cache key; execute the original text,
+    since sqlglot may render functions differently (json_extract becomes ->).
+    """
+    try:
+        statements = [statement for statement in sqlglot.parse(query, read="sqlite") if statement is not None]
+    except sqlglot.errors.SqlglotError as e:
+        raise ValueError("Invalid SQL query") from e
+    if len(statements) != 1:
+        raise ValueError("Only a single SQL statement is allowed")
+    tree = statements[0]
+    if not isinstance(tree, exp.Query) or tree.find(*_WRITE_EXPRESSIONS):
+        raise ValueError("Only SELECT queries are allowed")
+    return tree.sql(dialect="sqlite")
+
+
+def collapse_whitespace(question: str) -> str:
+    """Collapse runs of whitespace; case is kept, since SQLite's = is case-sensitive"""
+    return " ".join(question.split())
+
+
+def normalize_question(question: str) -> str:
+    """Lower-case and collapse whitespace so trivial variations embed the same way"""
+    return collapse_whitespace(question.lower())
+
+
+@functools.lru_cache(maxsize=8)
+def schema_hash(database_schema: str) -> str:
+    """Hash of the schema string, used to scope cache entries to one schema"""
+    return hashlib.sha256(database_schema.encode("utf-8")).hexdigest()
+
+
+class _Scope:
+    """Embedding matrix and cached SQL for one (schema, model) pair"""
+
+    def __init__(self, dim: int):
+        self.vectors = np.empty((0, dim), dtype=np.float32)
+        self.expires = np.empty(0, dtype=np.float64)
+        self.queries: List[str] = []
+
+
+class SemanticCache:
+    """
+    Two-layer cache of generated SQL queries.
+
+    Layer 1 is an exact-match LRU keyed on
+    sha256(whitespace-collapsed question + schema hash + model).
+    Layer 2 keeps unit-normalized question embeddings in a matrix per
+    schema/model, so a lookup is a single matmul against all stored questions.
+
+    Entries expire after ``ttl_s`` seconds. Callers should only ``put`` a query
+    after it executed successfully, so failing SQL is never served from cache.
+
+    When ``directory`` is given, exact matches are also persisted there for
+    ``disk_ttl_s`` seconds and reloaded into the LRU on a miss after a restart.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = 1024,
+        ttl_s: float = 3600.0,
+        threshold: float = 0.95,
+        directory: Optional[str] = None,
+        disk_ttl_s: float = 86400.0,
+        disk_size_limit: int = 2 ** 30,
+    ):
+        self.maxsize = maxsize
+        self.ttl_s = ttl_s
+        self.threshold = threshold
+        self.disk_ttl_s = disk_ttl_s
+        self._lock = threading.Lock()
+        self._exact: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._scopes: Dict[str, _Scope] = {}
+        self._disk = Cache(directory, size_limit=disk_size_limit) if directory else None
+
+    @staticmethod
+    def _key(question: str, database_schema: str, model: str) -> str:
+        raw = f"{collapse_whitespace(question)}\x00{schema_hash(database_schema)}\x00{model}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _disk_key(question: str, database_schema: str, model: str) -> str:
+        raw = f"{schema_hash(database_schema)}\x00{collapse_whitespace(question)}\x00{model}"
+        return xxhash.xxh3_64_hexdigest(raw)
+
+    @staticmethod
+    def _scope_key(database_schema: str, model: str) -> str:
+        return f"{schema_hash(database_schema)}:{model}"
+
+    def get(self, question: str, database_schema: str, model: str) -> Optional[str]:
+        """Return the cached SQL for an exact repeat (up to whitespace) of the question"""
+        key = self._key(question, database_schema, model)
+        with self._lock:
+            entry = self._exact.get(key)
+            if entry is not None:
+                query, expires = entry
+                if expires >= time.monotonic():
+                    self._exact.move_to_end(key)
+                    return query
+                del self._exact[key]
+        if self._disk is None:
+            return None
+
+        # Fall back to the persistent layer and promote a hit into the LRU
+        query = self._disk.get(self._disk_key(question, database_schema, model))
+        if query is not None:
+            with self._lock:
+                self._store_exact(key, query, time.monotonic() + self.ttl_s)
+        return query
+
+    def search(self, embedding: np.ndarray, database_schema: str, model: str) -> Optional[str]:
+        """Return the cached SQL of the most similar question, if above the threshold"""
+        with self._lock:
+            scope = self._scopes.get(self._scope_key(database_schema, model))
+            if scope is None or not scope.queries:
+                return None
+            scores = scope.vectors @ _unit(embedding)
+            scores[scope.expires < time.monotonic()] = -1.0
+            best = int(np.argmax(scores))
+            if scores[best] < self.threshold:
+                return None
+            return scope.queries[best]
+
+    def put(
+        self,
+        question: str,
+        database_schema: str,
+        model: str,
+        query: str,
+        embedding: Optional[np.ndarray] = None,
+    ) -> None:
+        """Store a successfully executed query for the question"""
+        now = time.monotonic()
+        expires = now + self.ttl_s
+        key = self._key(question, database_schema, model)
+        if self._disk is not None:
+            self._disk.set(self._disk_key(question, database_schema, model), query, expire=self.disk_ttl_s)
+        with self._lock:
+            self._store_exact(key, query, expires)
+
+            if embedding is None:
+                return
+            vector = _unit(embedding)
+            scope_key = self._scope_key(database_schema, model)
+            scope = self._scopes.get(scope_key)
+            if scope is None or scope.vectors.shape[1] != vector.shape[0]:
+                scope = self._scopes[scope_key] = _Scope(vector.shape[0])
+
+            # Drop expired rows, append the new one and keep the newest maxsize
+            live = scope.expires >= now
+            scope.vectors = np.vstack([scope.vectors[live], vector])[-self.maxsize:]
+            scope.expires = np.append(scope.expires[live], expires)[-self.maxsize:]
+            scope.queries = [q for q, keep in zip(scope.queries, live) if keep]
+            scope.queries.append(query)
+            scope.queries = scope.queries[-self.maxsize:]
+
+    def close(self) -> None:
+        """Close the persistent layer, if any"""
+        if self._disk is not None:
+            self._disk.close()
+
+    def _store_exact(self, key: str, query: str, expires: float) -> None:
+        # Caller holds self._lock
+        self._exact[key] = (query, expires)
+        self._exact.move_to_end(key)
+        while len(self._exact) > self.maxsize:
+            self._exact.popitem(last=False)
+
+
+def _unit(vector: np.ndarray) -> np.ndarray:
+    """Return the vector as float32 scaled to unit length"""
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
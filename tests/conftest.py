@@ -0,0 +1,81 @@
+import asyncio
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import types
+
+import pytest
+
+# main.py and app.py read their configuration at import time
+os.environ["DB_URL"] = os.path.join(tempfile.mkdtemp(), "test.db")
+os.environ["OPENAI_API_KEY"] = "test-key"
+os.environ["SQL_CACHE_DIR"] = ""
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def tool_call_response(arguments):
+    """Chat completion carrying a single tool call with the given arguments"""
+    function = types.SimpleNamespace(arguments=json.dumps(arguments))
+    message = types.SimpleNamespace(tool_calls=[types.SimpleNamespace(function=function)])
+    return types.SimpleNamespace(choices=[types.SimpleNamespace(message=message)])
+
+
+class FakeOpenAI:
+    """
+    Stand-in for AsyncOpenAI recording every request.
+
+    Single questions get `SELECT <n> AS n`, where n is the number of the call.
+    Batched questions get `SELECT <idx> AS n`, except indexes in `skip_idx`.
+    Set `fail_batch` to make batched calls raise. `messages` keeps the
+    messages of every chat completion request.
+    """
+
+    def __init__(self):
+        self.messages = []
+        self.single_calls = []
+        self.batch_calls = []
+        self.embedding_calls = []
+        self.skip_idx = set()
+        self.fail_batch = False
+        self.chat = types.SimpleNamespace(completions=types.SimpleNamespace(create=self._complete))
+        self.embeddings = types.SimpleNamespace(create=self._embed)
+
+    async def _complete(self, messages, model, tools, tool_choice=None):
+        await asyncio.sleep(0)
+        self.messages.append(messages)
+        content = messages[-1]["content"]
+        if tool_choice is None:
+            self.single_calls.append(content)
+            return tool_call_response({"query": f"SELECT {len(self.single_calls)} AS n"})
+        self.batch_calls.append(content)
+        if self.fail_batch:
+            raise RuntimeError("batch failed")
+        count = content.count("\n")
+        return tool_call_response({"queries": [
+            {"idx": idx, "query": f"SELECT {idx} AS n"}
+            for idx in range(1, count + 1) if idx not in self.skip_idx
+        ]})
+
+    async def _embed(self, model, input):
+        self.embedding_calls.append(input)
+        # Distinct questions get unrelated vectors, well below the similarity threshold
+        embedding = [float(byte) - 127.5 for byte in hashlib.sha256(input.encode()).digest()]
+        return types.SimpleNamespace(data=[types.SimpleNamespace(embedding=embedding)])
+
+    async def close(self):
+        pass
+
+
+@pytest.fixture
+def fake_openai(monkeypatch):
+    import main
+
+    client = FakeOpenAI()
+    monkeypatch.setattr(main, "openai_client", client)
+    monkeypatch.setattr(main, "sql_batcher", main.SQLQueryBatcher(8, 0.05))
+    monkeypatch.setattr(main, "sql_cache", main.SemanticCache())
+    main._question_embeddings.clear()
+    return client
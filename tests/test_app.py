@@ -0,0 +1,104 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("streamlit")
+app = pytest.importorskip("app")
+
+
+USERS = pd.DataFrame({
+    "name": ["ann", None, "ann", "bob"],
+    "id": [1, 2, 3, 4],
+    "age": [30, 40, 50, 20],
+})
+
+
+@pytest.mark.parametrize("query, question", [
+    ("SELECT name, age FROM users", "show all users"),
+    ("SELECT name, SUM(age) AS total FROM users GROUP BY name", "total age by name"),
+    ("SELECT name, age FROM users ORDER BY age", "users by age"),
+    ("SELECT * FROM users", "count users by name"),
+    ("SELECT 1 AS a, 2 AS b", "count by a"),
+])
+def test_aggregate_for_bar_chart_leaves_results_alone(query, question):
+    assert app.aggregate_for_bar_chart(USERS, query, question, ("id", "age")) is None
+
+
+def test_aggregate_for_bar_chart_groups_on_first_column():
+    aggregated = app.aggregate_for_bar_chart(
+        USERS, "SELECT name, id, age FROM users", "age by name", ("id", "age")
+    )
+    assert aggregated.index.tolist() == ["ann", "(null)", "bob"]
+    assert aggregated["sum_age"].tolist() == [80, 40, 20]
+    assert aggregated["row_count"].tolist() == [2, 1, 1]
+    assert "sum_id" not in aggregated
+
+
+def test_bar_chart_draws_null_group_key():
+    aggregated = app.aggregate_for_bar_chart(
+        USERS, "SELECT name, age FROM users", "age by name", ("age",)
+    )
+    fig = app.generate_visualization(aggregated, app.get_numeric_columns(aggregated), "Bar Chart")
+    labels = [label.get_text() for label in fig.axes[0].get_xticklabels()]
+    assert labels == ["ann", "(null)", "bob"]
+
+
+def test_bin2d_matches_histogram2d():
+    rng = np.random.default_rng(0)
+    x, y = rng.random(10_000), rng.random(10_000)
+    counts = app.bin2d(x, y, 20, 10, 0.0, 1.0, 0.0, 1.0)
+    expected, _, _ = np.histogram2d(x, y, bins=(20, 10), range=((0.0, 1.0), (0.0, 1.0)))
+    assert counts.sum() == x.size
+    np.testing.assert_array_equal(counts, expected)
+
+
+def test_bin2d_puts_range_maximum_in_last_cell():
+    counts = app.bin2d(np.array([1.0]), np.array([1.0]), 4, 4, 0.0, 1.0, 0.0, 1.0)
+    assert counts[3, 3] == 1
+
+
+def test_ask_database_keeps_mixed_column_values():
+    with app.connect_lock:
+        app.connect.execute("DROP TABLE IF EXISTS app_mixed")
+        app.connect.execute("CREATE TABLE app_mixed (value)")
+        app.connect.executemany("INSERT INTO app_mixed VALUES (?)", [(1,), (2.5,), ("text",)])
+        app.connect.commit()
+    query = "SELECT value FROM app_mixed ORDER BY rowid"
+    df = app.ask_database(query, query)
+    assert df["value"].tolist() == [1, 2.5, "text"]
+
+
+def test_ask_database_runs_the_original_query():
+    query = """SELECT json_extract('{"a": "x"}', '$.a') AS v"""
+    df = app.ask_database(app.canonicalize_sql(query), query)
+    assert df["v"].tolist() == ["x"]
+
+
+def test_embed_question_falls_back_to_exact_match(monkeypatch):
+    def unavailable(**kwargs):
+        raise RuntimeError("embeddings unavailable")
+
+    monkeypatch.setattr(app.client.embeddings, "create", unavailable)
+    assert app.embed_question("a question never embedded before") is None
+
+
+def test_hash_dataframe_covers_column_names():
+    df = pd.DataFrame({"a": [1, 2]})
+    assert app.hash_dataframe(df) != app.hash_dataframe(df.rename(columns={"a": "b"}))
+
+
+def test_render_visualization_returns_png():
+    df = pd.DataFrame({"x": [1.0, 2.0], "y": [3.0, 4.0]})
+    png = app.render_visualization(df, ("x", "y"), "Scatter Plot")
+    assert png.startswith(b"\x89PNG")
+    assert app.render_visualization(df, ("x", "y"), "Scatter Plot") == png
+
+
+def test_get_numeric_columns_includes_nullable_and_narrow_types():
+    df = pd.DataFrame({
+        "count": pd.array([1, None], dtype="Int64"),
+        "ratio": np.array([0.5, 1.5], dtype=np.float32),
+        "flag": [True, False],
+        "name": ["a", "b"],
+    })
+    assert app.get_numeric_columns(df) == ("count", "ratio")
@@ -0,0 +1,208 @@
+import asyncio
+import json
+import os
+import sqlite3
+
+import numpy as np
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+
+import main
+
+
+@pytest.fixture(scope="module", autouse=True)
+def database():
+    conn = sqlite3.connect(os.environ["DB_URL"])
+    conn.execute("DROP TABLE IF EXISTS mixed")
+    conn.execute("CREATE TABLE mixed (id INTEGER, value NUMERIC)")
+    conn.executemany("INSERT INTO mixed VALUES (?, ?)", [(i, i) for i in range(250)])
+    conn.execute("INSERT INTO mixed VALUES (250, 2.5)")
+    conn.commit()
+    conn.close()
+
+
+def generate_all(questions):
+    async def run():
+        try:
+            return await asyncio.gather(*(main.generate_sql_query(question, "schema") for question in questions))
+        finally:
+            await main.sql_batcher.stop()
+    return asyncio.run(run())
+
+
+def test_schema_message_comes_first_and_question_last(fake_openai):
+    generate_all(["how many rows?"])
+    messages = fake_openai.messages[0]
+    assert messages[0] is main.build_schema_message("schema")
+    assert messages[0]["role"] == "system"
+    assert messages[0]["content"].endswith("Database schema:\nschema")
+    assert messages[-1] == {"role": "user", "content": "how many rows?"}
+
+
+def test_cache_control_marks_the_schema_block(monkeypatch):
+    monkeypatch.setattr(main, "LLM_CACHE_CONTROL", True)
+    main.build_schema_message.cache_clear()
+    try:
+        message = main.build_schema_message("cache control schema")
+    finally:
+        main.build_schema_message.cache_clear()
+    assert message["role"] == "system"
+    [block] = message["content"]
+    assert block["type"] == "text"
+    assert block["text"].endswith("Database schema:\ncache control schema")
+    assert block["cache_control"] == {"type": "ephemeral"}
+
+
+def test_concurrent_questions_share_one_batch(fake_openai):
+    queries = generate_all(["q1", "q2", "q3"])
+    assert queries == ["SELECT 1 AS n", "SELECT 2 AS n", "SELECT 3 AS n"]
+    assert len(fake_openai.batch_calls) == 1
+    assert fake_openai.single_calls == []
+
+
+def test_question_missing_from_batch_is_retried_alone(fake_openai):
+    fake_openai.skip_idx = {2}
+    queries = generate_all(["q1", "q2", "q3"])
+    assert queries == ["SELECT 1 AS n", "SELECT 1 AS n", "SELECT 3 AS n"]
+    assert fake_openai.single_calls == ["q2"]
+
+
+def test_failed_batch_falls_back_to_single_requests(fake_openai):
+    fake_openai.fail_batch = True
+    queries = generate_all(["q1", "q2"])
+    assert sorted(fake_openai.single_calls) == ["q1", "q2"]
+    assert sorted(queries) == ["SELECT 1 AS n", "SELECT 2 AS n"]
+
+
+def test_single_question_skips_the_batch_call(fake_openai):
+    assert generate_all(["only"]) == ["SELECT 1 AS n"]
+    assert fake_openai.batch_calls == []
+
+
+def test_execute_query_survives_column_type_change(monkeypatch):
+    # The mismatching row arrives after several batches
+    monkeypatch.setattr(main, "RESULT_BATCH_ROWS", 100)
+    rows = [row for chunk in main.execute_query("SELECT * FROM mixed") for row in chunk]
+    assert len(rows) == 251
+    assert [row["id"] for row in rows] == list(range(251))
+    assert rows[-1] == {"id": 250, "value": 2.5}
+
+
+def test_execute_query_keeps_stored_types_within_a_batch():
+    query = "SELECT value FROM mixed WHERE id IN (1, 250) ORDER BY id"
+    rows = [row for chunk in main.execute_query(query) for row in chunk]
+    assert rows == [{"value": 1}, {"value": 2.5}]
+    assert type(rows[0]["value"]) is int
+
+
+def test_stream_closes_document_on_read_error():
+    completed = []
+
+    def chunks():
+        yield [{"n": 2}]
+        raise HTTPException(status_code=400, detail="Query execution error")
+
+    body = b"".join(main.stream_chat_response("SELECT n", [{"n": 1}], chunks(), lambda: completed.append(True)))
+    document = json.loads(body)
+    assert document["results"] == [{"n": 1}, {"n": 2}]
+    assert document["row_count"] == 2
+    assert document["error"] == "Query execution error"
+    assert completed == []
+
+
+def test_stream_runs_completion_callback():
+    completed = []
+    chunks = (chunk for chunk in [[{"n": 2}]])
+    body = b"".join(main.stream_chat_response("SELECT n", [{"n": 1}], chunks, lambda: completed.append(True)))
+    document = json.loads(body)
+    assert document["row_count"] == 2
+    assert "error" not in document
+    assert completed == [True]
+
+
+@pytest.mark.parametrize("names, expected", [
+    (["a", "b"], ["a", "b"]),
+    (["a", "a", "a"], ["a", "a.1", "a.2"]),
+    (["a", "a", "a.1"], ["a", "a.2", "a.1"]),
+])
+def test_dedupe_column_names(names, expected):
+    assert main.dedupe_column_names(names) == expected
+
+
+def test_load_csv_keeps_timestamps_as_text():
+    main.load_csv(b"ts,d,t,n\n2024-01-01 10:00:00,2024-01-01,10:00:00,1\n", "timestamps")
+    conn = sqlite3.connect(os.environ["DB_URL"])
+    row = conn.execute("SELECT ts, d, t, n FROM timestamps").fetchone()
+    conn.close()
+    assert row == ("2024-01-01 10:00:00", "2024-01-01", "10:00:00", 1)
+
+
+def test_load_csv_names_empty_headers_as_pandas_does():
+    table = main.load_csv(b"a,,b,\n1,2,3,4\n", "unnamed")
+    assert table.column_names == ["a", "Unnamed: 1", "b", "Unnamed: 3"]
+
+
+def test_load_csv_rejects_non_utf8():
+    with pytest.raises(ValueError):
+        main.load_csv(b"a,b\n1,\xe9\n", "latin")
+
+
+def test_chat_embeds_only_on_cache_miss(fake_openai):
+    with TestClient(main.app) as client:
+        first = client.post("/chat", json={"message": "values of mixed"})
+        # As after a restart: the SQL cache still has the query, the embeddings are gone
+        main._question_embeddings.clear()
+        second = client.post("/chat", json={"message": "values  of mixed"})
+    assert first.status_code == second.status_code == 200
+    assert second.json()["sql_query"] == first.json()["sql_query"]
+    assert fake_openai.embedding_calls == ["values of mixed"]
+    assert len(fake_openai.single_calls) == 1
+
+
+def test_chat_rejects_untokenizable_sql(fake_openai, monkeypatch):
+    async def unterminated(question, database_schema):
+        return "SELECT 'abc"
+
+    monkeypatch.setattr(main, "generate_sql_query", unterminated)
+    with TestClient(main.app) as client:
+        response = client.post("/chat", json={"message": "anything"})
+    assert response.status_code == 400
+
+
+def test_schema_string_is_rebuilt_after_upload(fake_openai):
+    with TestClient(main.app) as client:
+        client.post("/chat", json={"message": "before upload"})
+        upload = client.post("/upload-csv?table_name=fresh_upload", files={"file": ("f.csv", b"x,y\n1,2\n")})
+        client.post("/chat", json={"message": "after upload"})
+    assert upload.status_code == 200
+    before, after = (messages[0]["content"] for messages in fake_openai.messages)
+    assert "fresh_upload" not in before
+    assert "Table: fresh_upload\nColumns: x, y" in after
+
+
+def test_chat_runs_the_query_as_generated(fake_openai, monkeypatch):
+    query = """SELECT json_extract('{"a": "x"}', '$.a') AS v"""
+
+    async def json_query(question, database_schema):
+        return query
+
+    monkeypatch.setattr(main, "generate_sql_query", json_query)
+    with TestClient(main.app) as client:
+        response = client.post("/chat", json={"message": "json value"})
+    expected = sqlite3.connect(":memory:").execute(query).fetchone()[0]
+    assert response.json()["sql_query"] == query
+    assert expected == "x"
+    assert response.json()["results"] == [{"v": expected}]
+
+
+def test_orjson_response_renders_numpy_scalars():
+    response = main.ORJSONResponse({"n": np.int64(1), "x": np.float32(0.5), "v": np.arange(2)})
+    assert json.loads(response.body) == {"n": 1, "x": 0.5, "v": [0, 1]}
+
+
+@pytest.mark.parametrize("table_name", ["1abc", "9", "bad-name"])
+def test_upload_rejects_invalid_table_names(table_name):
+    with TestClient(main.app) as client:
+        response = client.post(f"/upload-csv?table_name={table_name}", files={"file": ("f.csv", b"x\n1\n")})
+    assert response.status_code == 400
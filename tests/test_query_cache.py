@@ -0,0 +1,86 @@
+import numpy as np
+import pytest
+
+import query_cache
+from query_cache import SemanticCache, canonicalize_sql
+
+
+def test_canonicalize_sql_normalizes_spelling():
+    assert canonicalize_sql("select  *  from t") == canonicalize_sql("SELECT * FROM t")
+
+
+@pytest.mark.parametrize("query, message", [
+    ("SELECT 'abc", "Invalid SQL query"),
+    ("SELECT 1; SELECT 2", "Only a single SQL statement is allowed"),
+    ("DELETE FROM t", "Only SELECT queries are allowed"),
+    ("DROP TABLE t", "Only SELECT queries are allowed"),
+    ("WITH d AS (DELETE FROM t RETURNING *) SELECT * FROM d", None),
+])
+def test_canonicalize_sql_rejects(query, message):
+    with pytest.raises(ValueError) as info:
+        canonicalize_sql(query)
+    if message is not None:
+        assert str(info.value) == message
+
+
+def test_exact_hit_ignores_whitespace_but_not_case():
+    cache = SemanticCache()
+    cache.put("orders for customer 'ACME'", "schema", "model", "SELECT 1")
+    assert cache.get("  orders for   customer 'ACME'", "schema", "model") == "SELECT 1"
+    assert cache.get("orders for customer 'acme'", "schema", "model") is None
+
+
+def test_entries_are_scoped_to_schema_and_model():
+    cache = SemanticCache()
+    cache.put("q", "schema", "model", "SELECT 1", np.ones(3))
+    assert cache.get("q", "other schema", "model") is None
+    assert cache.get("q", "schema", "other model") is None
+    assert cache.search(np.ones(3), "other schema", "model") is None
+
+
+def test_entries_expire(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(query_cache.time, "monotonic", lambda: now[0])
+    cache = SemanticCache(ttl_s=10)
+    cache.put("q", "schema", "model", "SELECT 1", np.ones(3))
+    now[0] += 11
+    assert cache.get("q", "schema", "model") is None
+    assert cache.search(np.ones(3), "schema", "model") is None
+
+
+def test_lru_evicts_oldest_entry():
+    cache = SemanticCache(maxsize=2)
+    for question in ("a", "b", "c"):
+        cache.put(question, "schema", "model", f"SELECT '{question}'")
+    assert cache.get("a", "schema", "model") is None
+    assert cache.get("c", "schema", "model") == "SELECT 'c'"
+
+
+def test_semantic_search_respects_threshold():
+    cache = SemanticCache(threshold=0.95)
+    cache.put("q", "schema", "model", "SELECT 1", np.array([1.0, 0.0]))
+    assert cache.search(np.array([2.0, 0.1]), "schema", "model") == "SELECT 1"
+    assert cache.search(np.array([1.0, 1.0]), "schema", "model") is None
+
+
+def test_disk_layer_survives_a_new_instance(tmp_path):
+    cache = SemanticCache(directory=str(tmp_path))
+    cache.put("q", "schema", "model", "SELECT 1")
+    cache.close()
+
+    reopened = SemanticCache(directory=str(tmp_path))
+    try:
+        assert reopened.get("q", "schema", "model") == "SELECT 1"
+        assert reopened.get("q", "other schema", "model") is None
+    finally:
+        reopened.close()
+
+
+def test_disk_entries_expire(tmp_path):
+    cache = SemanticCache(directory=str(tmp_path), disk_ttl_s=-1)
+    try:
+        cache.put("q", "schema", "model", "SELECT 1")
+        cache._exact.clear()
+        assert cache.get("q", "schema", "model") is None
+    finally:
+        cache.close()